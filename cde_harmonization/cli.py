@@ -13,9 +13,14 @@ def categorize(args):
     categorizer_name = args.categorizer
     score_threshold = args.score_threshold
     workers = args.workers
+    share_models = args.share_models
+    corpus_scoring = args.corpus_scoring
     verbose = args.verbose
     quiet = args.quiet
 
+    if corpus_scoring and categorizer_name != "rake":
+        args.parser.error("--corpus_scoring is only supported by the rake categorizer")
+
     log_level = logging.ERROR if quiet else (
         logging.DEBUG if verbose else logging.INFO
     )
@@ -31,6 +36,8 @@ def categorize(args):
     categorizer = None
     options = {
         "score_threshold": score_threshold,
+        "share_models": share_models,
+        **({"corpus_scoring": corpus_scoring} if categorizer_name == "rake" else {}),
         **({"workers": workers} if workers is not None else {})
     }
     if categorizer_name == "scigraph":
@@ -54,10 +61,15 @@ def analyze(args):
     similarity_threshold = args.similarity_threshold
     analyzer_name = args.analyzer
     id_field = args.id_field
+    top_k = args.top_k
+    mutual = args.mutual
     workers = args.workers
     verbose = args.verbose
     quiet = args.quiet
 
+    if mutual and top_k is None:
+        args.parser.error("--mutual requires --top_k")
+
     log_level = logging.ERROR if quiet else (
         logging.DEBUG if verbose else logging.INFO
     )
@@ -74,6 +86,8 @@ def analyze(args):
 
     options = {
         "min_score": similarity_threshold,
+        "top_k": top_k,
+        "mutual": mutual,
         "grouping_method": grouping_method,
         "id": id_field,
         **({"workers": workers} if workers is not None else {})
@@ -97,8 +111,146 @@ def analyze(args):
             os.path.splitext(output_path)[0] + ".gexf"
         )
 
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value}")
+    return number
+
+# Categorizer class names by their CLI names, as recorded in harmonization indexes.
+CATEGORIZER_CLASS_NAMES = {
+    "scigraph": "SciGraphAnnotationCategorizer",
+    "rake": "RakeKeywordCategorizer",
+    "keybert": "KeyBERTCategorizer"
+}
+
+def build_index(args):
+    from .grouping.semantic_analyzer import USE4Analyzer
+    from .grouping.index import HarmonizationIndex
+
+    cde_file = args.cde_file
+    output_path = args.output_path
+    fields = list(set(args.field)) if args.field is not None else ["description"]
+    analyzer_name = args.analyzer
+    id_field = args.id_field
+    categorizer_name = args.categorizer
+    categorize_fields = list(set(args.categorize_field)) if args.categorize_field is not None else ["description"]
+    score_threshold = args.score_threshold
+    corpus_scoring = args.corpus_scoring
+    verbose = args.verbose
+    quiet = args.quiet
+
+    if corpus_scoring and categorizer_name != "rake":
+        args.parser.error("--corpus_scoring is only supported by the rake categorizer")
+    if corpus_scoring and score_threshold > 0:
+        # Queries categorize rows individually, which can't reproduce thresholds applied to corpus-level scores.
+        args.parser.error("Indexes cannot be queried when categorized with --corpus_scoring and a non-zero --score_threshold")
+
+    log_level = logging.ERROR if quiet else (
+        logging.DEBUG if verbose else logging.INFO
+    )
+    logging.basicConfig(
+        level=log_level,
+        format="%(name)s - %(levelname)s - %(message)s",
+        datefmt="%H:%M:%S"
+    )
+
+    cde_loader = CDELoader({
+        "csv_parse_lists": ["categories"]
+    })
+    cde = cde_loader.load(cde_file)
+
+    options = {
+        "id": id_field
+    }
+    if analyzer_name == "use4":
+        analyzer = USE4Analyzer(fields, options)
+
+    categorization = HarmonizationIndex.make_categorization(
+        CATEGORIZER_CLASS_NAMES[categorizer_name],
+        categorize_fields,
+        score_threshold,
+        corpus_scoring
+    )
+    index = HarmonizationIndex.build(cde, analyzer, categorization)
+    index.save(output_path)
+
+def query(args):
+    from .grouping.categorizer import SciGraphAnnotationCategorizer, RakeKeywordCategorizer, KeyBERTCategorizer
+    from .grouping.semantic_analyzer import USE4Analyzer
+    from .grouping.index import HarmonizationIndex
+
+    index_path = args.index_path
+    cde_file = args.cde_file
+    output_path = args.output_path
+    categorize_fields = list(set(args.categorize_field)) if args.categorize_field is not None else None
+    categorizer_name = args.categorizer
+    score_threshold = args.score_threshold
+    analyzer_name = args.analyzer
+    grouping_method = args.grouping_method
+    similarity_threshold = args.similarity_threshold
+    top_k = args.top_k
+    verbose = args.verbose
+    quiet = args.quiet
+
+    log_level = logging.ERROR if quiet else (
+        logging.DEBUG if verbose else logging.INFO
+    )
+    logging.basicConfig(
+        level=log_level,
+        format="%(name)s - %(levelname)s - %(message)s",
+        datefmt="%H:%M:%S"
+    )
+
+    index = HarmonizationIndex.load(index_path)
+    # Analysis has to be performed on the same fields that the index was embedded on.
+    fields = index.fields
+    # Categorization defaults to the settings the index was categorized with, so that categories are comparable.
+    categorization = index.categorization if index.categorization is not None else {}
+    if categorizer_name is None:
+        categorizer_name = {
+            class_name: name for (name, class_name) in CATEGORIZER_CLASS_NAMES.items()
+        }.get(categorization.get("categorizer"))
+        if categorizer_name is None:
+            raise Exception("Index does not record its categorizer, specify one with --categorizer")
+    if categorize_fields is None:
+        categorize_fields = categorization.get("fields", ["description"])
+    if score_threshold is None:
+        score_threshold = categorization.get("score_threshold", 0)
+
+    cde_loader = CDELoader()
+    cde = cde_loader.load(cde_file)
+
+    categorizer = None
+    categorizer_options = {
+        "score_threshold": score_threshold,
+        "field_name": index.category_field
+    }
+    if categorizer_name == "scigraph":
+        categorizer = SciGraphAnnotationCategorizer(categorize_fields, categorizer_options)
+    elif categorizer_name == "rake":
+        categorizer = RakeKeywordCategorizer(categorize_fields, categorizer_options)
+    elif categorizer_name == "keybert":
+        categorizer = KeyBERTCategorizer(categorize_fields, categorizer_options)
+
+    analyzer_options = {
+        "id": index.id_field
+    }
+    if analyzer_name == "use4":
+        analyzer = USE4Analyzer(fields, analyzer_options)
+
+    matched_cde = index.query(
+        cde,
+        categorizer,
+        analyzer,
+        min_score=similarity_threshold,
+        top_k=top_k,
+        grouping_method=grouping_method
+    )
+    cde_loader.save(matched_cde, output_path)
+
 def make_categorize_parser(parser):
-    parser.set_defaults(func=categorize)
+    parser.set_defaults(func=categorize, parser=parser)
     parser.add_argument(
         "cde_file",
         type=str,
@@ -138,6 +290,20 @@ def make_categorize_parser(parser):
         type=int,
         help="Number of worker processes to use. Uses the maximum available if unspecified."
     )
+    parser.add_argument(
+        "-m",
+        "--share_models",
+        default=False,
+        action="store_true",
+        help="Share the loaded models with worker processes through fork copy-on-write instead of loading them once per worker."
+    )
+    parser.add_argument(
+        "-r",
+        "--corpus_scoring",
+        default=False,
+        action="store_true",
+        help="(rake only) Score keyphrases over the entire CDE in a single pass rather than per field."
+    )
     logging_group = parser.add_mutually_exclusive_group()
     logging_group.add_argument(
         "-v",
@@ -156,7 +322,7 @@ def make_categorize_parser(parser):
     return parser
 
 def make_analyzer_parser(parser):
-    parser.set_defaults(func=analyze)
+    parser.set_defaults(func=analyze, parser=parser)
     parser.add_argument(
         "cde_file",
         type=str,
@@ -213,6 +379,20 @@ def make_analyzer_parser(parser):
         type=float,
         help="Minimum semantic similarity of two CDE questions to be deemed significantly similar"
     )
+    parser.add_argument(
+        "-k",
+        "--top_k",
+        default=None,
+        type=positive_int,
+        help="Only keep each CDE's k highest scoring pairings. Keeps all pairings above the similarity threshold if unspecified."
+    )
+    parser.add_argument(
+        "-m",
+        "--mutual",
+        default=False,
+        action="store_true",
+        help="Only keep pairings where both CDEs are within each other's top k pairings. Requires --top_k."
+    )
     parser.add_argument(
         "-w",
         "--workers",
@@ -237,6 +417,178 @@ def make_analyzer_parser(parser):
     )
     return parser
 
+def make_build_index_parser(parser):
+    parser.set_defaults(func=build_index, parser=parser)
+    parser.add_argument(
+        "cde_file",
+        type=str,
+        help="File path to categorized CDE file (output of categorize) to build the index from"
+    )
+    parser.add_argument(
+        "output_path",
+        type=str,
+        help="Directory path to save the index under"
+    )
+    parser.add_argument(
+        "-a",
+        "--analyzer",
+        type=str,
+        required=True,
+        choices=["use4"],
+        help="Semantic analysis algorithm used to embed the indexed CDE questions"
+    )
+    parser.add_argument(
+        "-f",
+        "--field",
+        default=None,
+        action="append",
+        help="Only these specified columns will be embedded for semantic analysis"
+    )
+    parser.add_argument(
+        "-i",
+        "--id_field",
+        default="Digest (variable_name|source_file|source_directory)",
+        action="store",
+        help="Column name that uniquely identifies a row (CDE) within the digest"
+    )
+    parser.add_argument(
+        "-c",
+        "--categorizer",
+        type=str,
+        required=True,
+        choices=["scigraph", "rake", "keybert"],
+        help="Categorization algorithm that the CDE file was categorized with. Recorded in the index as the default for queries"
+    )
+    parser.add_argument(
+        "-F",
+        "--categorize_field",
+        default=None,
+        action="append",
+        help="Columns that the CDE file was categorized on. Recorded in the index as the default for queries"
+    )
+    parser.add_argument(
+        "-S",
+        "--score_threshold",
+        default=0,
+        type=float,
+        help="Category score threshold that the CDE file was categorized with. Recorded in the index as the default for queries"
+    )
+    parser.add_argument(
+        "-r",
+        "--corpus_scoring",
+        default=False,
+        action="store_true",
+        help="(rake only) Whether the CDE file was categorized with corpus-level scoring. Requires a score threshold of 0," \
+            " since queries score rows individually"
+    )
+    logging_group = parser.add_mutually_exclusive_group()
+    logging_group.add_argument(
+        "-v",
+        "--verbose",
+        default=False,
+        action="store_true",
+        help="Run in verbose mode. Verbose output of debugging information"
+    )
+    logging_group.add_argument(
+        "-q",
+        "--quiet",
+        default=False,
+        action="store_true",
+        help="Run in quiet mode. Only output errors."
+    )
+    return parser
+
+def make_query_parser(parser):
+    parser.set_defaults(func=query)
+    parser.add_argument(
+        "index_path",
+        type=str,
+        help="Directory path of an index created by build-index"
+    )
+    parser.add_argument(
+        "cde_file",
+        type=str,
+        help="File path to the new CDE file to match against the index"
+    )
+    parser.add_argument(
+        "output_path",
+        type=str,
+        help="File path to output the matched CDE under"
+    )
+    parser.add_argument(
+        "-c",
+        "--categorizer",
+        type=str,
+        default=None,
+        choices=["scigraph", "rake", "keybert"],
+        help="Categorization algorithm to employ. Defaults to the one that the indexed CDE was categorized with"
+    )
+    parser.add_argument(
+        "-a",
+        "--analyzer",
+        type=str,
+        required=True,
+        choices=["use4"],
+        help="Semantic analysis algorithm to employ. Should be the same one that the index was built with"
+    )
+    parser.add_argument(
+        "-F",
+        "--categorize_field",
+        default=None,
+        action="append",
+        help="Only these specified columns will be used by the categorization algorithm." \
+            " Defaults to the columns that the indexed CDE was categorized on." \
+            " Analysis always uses the columns that the index was built on"
+    )
+    parser.add_argument(
+        "-S",
+        "--score_threshold",
+        default=None,
+        type=float,
+        help="Minimum score of a category (varies by categorizer) required for a field to be marked with the category." \
+            " Defaults to the threshold that the indexed CDE was categorized with"
+    )
+    parser.add_argument(
+        "-g",
+        "--grouping_method",
+        type=str,
+        default="intersection",
+        choices=["equivalence", "intersection"],
+        help="Method of selecting candidate CDEs from the index." \
+            " Equivalence requires identical sets of categories," \
+            " while intersection only requires intersecting sets of categories"
+    )
+    parser.add_argument(
+        "-s",
+        "--similarity_threshold",
+        default=0.5,
+        type=float,
+        help="Minimum semantic similarity of two CDE questions to be deemed significantly similar"
+    )
+    parser.add_argument(
+        "-k",
+        "--top_k",
+        default=None,
+        type=positive_int,
+        help="Maximum number of matches to keep per CDE. Keeps all matches above the similarity threshold if unspecified."
+    )
+    logging_group = parser.add_mutually_exclusive_group()
+    logging_group.add_argument(
+        "-v",
+        "--verbose",
+        default=False,
+        action="store_true",
+        help="Run in verbose mode. Verbose output of debugging information"
+    )
+    logging_group.add_argument(
+        "-q",
+        "--quiet",
+        default=False,
+        action="store_true",
+        help="Run in quiet mode. Only output errors."
+    )
+    return parser
+
 def get_parser():
     parser = argparse.ArgumentParser(description="CDE Harmonization Tools")
     parser.set_defaults(func=lambda _args: parser.print_usage())
@@ -244,6 +596,8 @@ def get_parser():
     subparsers = parser.add_subparsers(title="Commands")
     make_categorize_parser(subparsers.add_parser("categorize", help="Generate categorical groupings on CDE data dictionaries"))
     make_analyzer_parser(subparsers.add_parser("analyze", help="Perform semantic analysis on categorically-grouped CDE questions"))
+    make_build_index_parser(subparsers.add_parser("build-index", help="Build a harmonization index from a categorized CDE for matching new CDEs"))
+    make_query_parser(subparsers.add_parser("query", help="Match a new CDE data dictionary against a harmonization index"))
 
     return parser
 
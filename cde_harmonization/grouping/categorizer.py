@@ -4,18 +4,41 @@ import string
 import re
 import spacy
 import time
+import gc
 import requests
 import multiprocessing
+import multiprocessing.pool
+import nltk
+import numpy as np
 from copy import deepcopy
 from itertools import chain
 from abc import ABC, abstractmethod
-from typing import List, Dict
+from typing import List, Dict, Tuple, Optional
 from rake_nltk import Rake
 from keyphrase_vectorizers import KeyphraseCountVectorizer
 from keybert import KeyBERT
 
 CDE = List[Dict]
 
+# Categorizer used by pool workers. Either inherited from the parent through fork (shared copy-on-write),
+# or constructed once per worker by `init_worker` so that models never have to be pickled.
+worker_categorizer = None
+# Set if `init_worker` failed. A raising initializer makes the pool endlessly replace dead workers (hanging the run),
+# so the failure is instead caught and reported back through `categorize_chunk`.
+worker_error = None
+
+def init_worker(categorizer_cls: type, fields: List[str], options: Dict) -> None:
+    global worker_categorizer, worker_error
+    try:
+        worker_categorizer = categorizer_cls(fields, options)
+    except Exception as e:
+        worker_error = f"{e.__class__.__name__}: {e}"
+
+def categorize_chunk(chunk: List[Tuple[int, Dict]]) -> List[Tuple[int, Optional[List[str]]]]:
+    if worker_categorizer is None:
+        raise Exception(f"Worker failed to load categorizer: {worker_error}")
+    return [(i, worker_categorizer.categorize_row(row)) for (i, row) in chunk]
+
 class Categorizer(ABC):
     NLP_MODEL = "en_core_web_sm"
     def __init__(self, fields: List[str], options={}):
@@ -24,11 +47,18 @@ class Categorizer(ABC):
             "field_name": "categories",
             "score_threshold": 0,
             "workers": multiprocessing.cpu_count(),
+            # Name or path of the spaCy pipeline used for normalization
+            "nlp_model": self.NLP_MODEL,
+            # Number of size-balanced chunks dispatched per worker. More chunks balance better but cost more IPC.
+            "chunks_per_worker": 4,
+            # Share the parent's already loaded models with workers through fork copy-on-write,
+            # rather than having each worker load its own copy. Only available on platforms that support fork.
+            "share_models": False,
             **options
         }
         self.fields = fields
         
-        self.nlp = self.load_nlp()
+        self.nlp = self.load_nlp(self.options["nlp_model"])
 
         self.logger = logging.getLogger(self.__class__.__name__)
     
@@ -37,12 +67,13 @@ class Categorizer(ABC):
         ...
 
     @classmethod
-    def load_nlp(cls):
+    def load_nlp(cls, model: str=None):
+        model = model if model is not None else cls.NLP_MODEL
         try:
-            return spacy.load(cls.NLP_MODEL)
+            return spacy.load(model)
         except ModuleNotFoundError:
-            spacy.cli.download(cls.NLP_MODEL)
-            return spacy.load(cls.NLP_MODEL)
+            spacy.cli.download(model)
+            return spacy.load(model)
 
     
     """ Text normalization of categories """
@@ -51,50 +82,198 @@ class Categorizer(ABC):
         lemma = [token.lemma_ for token in doc]
         return " ".join([word for word in lemma if self.nlp.vocab[word].is_stop == False and not word in string.punctuation])
 
+    """ Categorize and normalize a single row. Returns None if categorization failed. """
+    def categorize_row(self, cde_row: Dict) -> Optional[List[str]]:
+        try:
+            categories = list(set([
+                self.normalize(category) for category in self.categorize_field(cde_row)
+            ]))
+            return [category for category in categories if category != ""]
+        except Exception as e:
+            self.logger.error(f"Failed to categorize fields {[cde_row.get(field) for field in self.fields]}: {e}", exc_info=True)
+            return None
+
+    def make_chunks(self, rows: CDE) -> List[List[Tuple[int, Dict]]]:
+        """ Split index-tagged rows into chunks of roughly equal text length, largest chunks first """
+        num_chunks = max(1, self.options["workers"] * self.options["chunks_per_worker"])
+        sizes = [sum(len(str(row.get(field, ""))) for field in self.fields) + 1 for row in rows]
+        budget = sum(sizes) / num_chunks
+        chunks = [[]]
+        chunk_size = 0
+        for i, row in enumerate(rows):
+            if chunk_size >= budget:
+                chunks.append([])
+                chunk_size = 0
+            chunks[-1].append((i, row))
+            chunk_size += sizes[i]
+        # Dispatch the most expensive chunks first so that stragglers don't hold up the end of the run.
+        return sorted(
+            [chunk for chunk in chunks if len(chunk) > 0],
+            key=lambda chunk: sum(sizes[i] for (i, _) in chunk),
+            reverse=True
+        )
+
+    def make_pool(self, num_workers: int) -> multiprocessing.pool.Pool:
+        """
+        Workers either share this categorizer's models or load their own with the same settings.
+        Either way, the models have already loaded successfully in the parent by the time the pool is started.
+        """
+        global worker_categorizer
+        if self.options["share_models"]:
+            if "fork" in multiprocessing.get_all_start_methods():
+                worker_categorizer = self
+                # Keep the GC from touching (and so copying) the parent's model objects in the workers.
+                gc.freeze()
+                try:
+                    return multiprocessing.get_context("fork").Pool(processes=num_workers)
+                finally:
+                    gc.unfreeze()
+            self.logger.warning("Model sharing requires the fork start method, loading models per worker instead")
+        return multiprocessing.Pool(
+            processes=num_workers,
+            initializer=init_worker,
+            initargs=(self.__class__, self.fields, self.options)
+        )
+
     def categorize_cde(self, cde: CDE) -> CDE:
+        global worker_categorizer
         start_time = time.time_ns()
         num_workers = self.options["workers"]
         self.logger.info(f"Categorizing CDE fields using fields {self.fields} using {num_workers} workers")
         category_field_name = self.options["field_name"]
         rows = deepcopy(cde)
-        pool = multiprocessing.Pool(processes=num_workers)
-        results = pool.imap(self.categorize_field, rows)
+        chunks = self.make_chunks(rows)
+        self.logger.debug(f"Dispatching {len(rows)} fields in {len(chunks)} chunks")
+        pool = self.make_pool(num_workers)
+        results = pool.imap_unordered(categorize_chunk, chunks)
         pool.close()
-        i = 0
-        while True:
-            try:
-                result = next(results)
-                field = rows[i]
-                categories = list(set([
-                    self.normalize(category) for category in result
-                ]))
-                categories = [category for category in categories if category != ""]
-                field[category_field_name] = categories
-                if len(categories) == 0:
-                    self.logger.error(f"[{i + 1}/{len(rows)}] No categories found for field")
-                self.logger.debug(f"[{i + 1}/{len(rows)}] Categorized field under {categories}")
-            except StopIteration:
-                break
-            except Exception as exc:
-                self.logger.error(f"[{i + 1}/{len(rows)}] Failed to categorize field")
-            finally:
-                i += 1
+        completed = 0
+        try:
+            for chunk_results in results:
+                for (i, categories) in chunk_results:
+                    completed += 1
+                    if categories is None:
+                        self.logger.error(f"[{completed}/{len(rows)}] Failed to categorize field {i + 1}")
+                        continue
+                    rows[i][category_field_name] = categories
+                    if len(categories) == 0:
+                        self.logger.error(f"[{completed}/{len(rows)}] No categories found for field {i + 1}")
+                    self.logger.debug(f"[{completed}/{len(rows)}] Categorized field {i + 1} under {categories}")
+        except Exception:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            worker_categorizer = None
         self.logger.debug(f"CDE categorization completed in {(time.time_ns() - start_time) / 1E9:.2f} seconds")
         return rows
 
 """ Categorize fields using keyword extraction via RAKE """
 class RakeKeywordCategorizer(Categorizer):
+    def __init__(self, fields: List[str], options={}):
+        super().__init__(fields, {
+            # Score words by degree/frequency over the entire CDE rather than per row.
+            # Runs in a single pass in-process, since it is model-free and cheap compared to worker overhead.
+            "corpus_scoring": False,
+            **options
+        })
+        # Reuse one extractor (and its loaded stopwords/punctuation) for every row.
+        self.rake = Rake()
+
+    def get_text(self, cde_row: Dict) -> str:
+        return ". ".join([cde_row[field] for field in self.fields if cde_row.get(field, "") != ""])
+
     def categorize_field(self, cde_row: Dict) -> List[str]:
-        r = Rake()
-        for field in self.fields:
-            r.extract_keywords_from_text(cde_row[field])
-        return r.get_ranked_phrases()
+        minimum_score = self.options["score_threshold"]
+        self.rake.extract_keywords_from_text(self.get_text(cde_row))
+        return [
+            phrase for (score, phrase)
+            in self.rake.get_ranked_phrases_with_scores()
+            if score >= minimum_score
+        ]
+
+    """ Split text into candidate phrases (lowercased words between stopwords/punctuation), as RAKE does """
+    def split_phrases(self, text: str) -> List[List[str]]:
+        phrases = []
+        for sentence in nltk.tokenize.sent_tokenize(text):
+            phrase = []
+            for word in nltk.tokenize.wordpunct_tokenize(sentence.lower()):
+                if word in self.rake.stopwords or all(char in self.rake.punctuations for char in word):
+                    if len(phrase) > 0: phrases.append(phrase)
+                    phrase = []
+                else:
+                    phrase.append(word)
+            if len(phrase) > 0: phrases.append(phrase)
+        return phrases
+
+    def categorize_cde(self, cde: CDE) -> CDE:
+        if not self.options["corpus_scoring"]:
+            return super().categorize_cde(cde)
+        start_time = time.time_ns()
+        self.logger.info(f"Categorizing CDE fields using fields {self.fields} using corpus-level RAKE scoring")
+        category_field_name = self.options["field_name"]
+        minimum_score = self.options["score_threshold"]
+        rows = deepcopy(cde)
+
+        # Tokenize every row in one pass, flattening phrases into arrays of word ids.
+        vocabulary = {}
+        phrases = []
+        word_ids = []
+        phrase_lengths = []
+        row_phrase_counts = []
+        for row in rows:
+            row_phrases = self.split_phrases(self.get_text(row))
+            for phrase in row_phrases:
+                phrases.append(" ".join(phrase))
+                word_ids += [vocabulary.setdefault(word, len(vocabulary)) for word in phrase]
+                phrase_lengths.append(len(phrase))
+            row_phrase_counts.append(len(row_phrases))
+        word_ids = np.asarray(word_ids, dtype=np.int64)
+        phrase_lengths = np.asarray(phrase_lengths, dtype=np.int64)
+
+        # Word degree is the total length of the phrases a word occurs in, word score is degree / frequency.
+        # Phrase score is the sum of its word scores.
+        frequency = np.bincount(word_ids, minlength=len(vocabulary))
+        degree = np.bincount(word_ids, weights=np.repeat(phrase_lengths, phrase_lengths), minlength=len(vocabulary))
+        word_scores = degree / np.maximum(frequency, 1)
+        phrase_scores = (
+            np.add.reduceat(word_scores[word_ids], np.cumsum(phrase_lengths) - phrase_lengths)
+            if len(phrases) > 0 else np.zeros(0)
+        )
+        self.logger.debug(f"Scored {len(phrases)} phrases over a vocabulary of {len(vocabulary)} words")
+
+        # Phrases recur heavily across a CDE, so only normalize each distinct phrase once.
+        normalized = {}
+        row_ends = np.cumsum(row_phrase_counts)
+        for i, row in enumerate(rows):
+            start, end = row_ends[i] - row_phrase_counts[i], row_ends[i]
+            scores = phrase_scores[start:end]
+            categories = []
+            for j in np.argsort(-scores, kind="stable"):
+                if scores[j] < minimum_score:
+                    break
+                phrase = phrases[start + j]
+                if phrase not in normalized:
+                    normalized[phrase] = self.normalize(phrase)
+                if normalized[phrase] != "" and normalized[phrase] not in categories:
+                    categories.append(normalized[phrase])
+            row[category_field_name] = categories
+            if len(categories) == 0:
+                self.logger.error(f"[{i + 1}/{len(rows)}] No categories found for field")
+            self.logger.debug(f"[{i + 1}/{len(rows)}] Categorized field under {categories}")
+        self.logger.debug(f"CDE categorization completed in {(time.time_ns() - start_time) / 1E9:.2f} seconds")
+        return rows
 
 """ Categorize fields using keyword extraction via KeyBERT """
 class KeyBERTCategorizer(Categorizer):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.model = KeyBERT()
+    # Default embedding model of KeyBERT. Can also be a path to a locally saved sentence-transformers model.
+    KEYBERT_MODEL = "all-MiniLM-L6-v2"
+    def __init__(self, fields: List[str], options={}):
+        super().__init__(fields, {
+            "keybert_model": self.KEYBERT_MODEL,
+            **options
+        })
+        self.model = KeyBERT(model=self.options["keybert_model"])
         self.vectorizer = KeyphraseCountVectorizer()
     def categorize_field(self, cde_row: Dict) -> List[str]:
         docs = [cde_row[field] for field in self.fields]
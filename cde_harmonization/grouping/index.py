@@ -0,0 +1,256 @@
+""" Prebuilt harmonization index for matching new CDEs against an existing catalogue without re-running analysis """
+import logging
+import os
+import json
+import time
+import numpy as np
+from copy import deepcopy
+from collections import defaultdict
+from typing import List, Dict, Optional
+from .categorizer import Categorizer
+from .semantic_analyzer import SemanticAnalyzer
+
+CDE = List[Dict]
+
+logger = logging.getLogger(__name__)
+
+class HarmonizationIndex:
+    METADATA_FILE = "index.json"
+    EMBEDDINGS_FILE = "embeddings.npy"
+    # Number of sentences embedded per model call when building the index
+    EMBEDDING_BATCH_SIZE = 256
+
+    def __init__(
+        self,
+        ids: List[str],
+        categories: List[List[str]],
+        embeddings: np.ndarray,
+        fields: List[str],
+        id_field: str,
+        category_field: str="categories",
+        source_directories: Optional[List[Optional[str]]]=None,
+        categorization: Optional[Dict]=None,
+        inverted_index: Optional[Dict[str, np.ndarray]]=None
+    ):
+        self.ids = ids
+        self.categories = categories
+        # Embeddings are stored L2-normalized so that cosine similarity reduces to a dot product.
+        self.embeddings = embeddings
+        self.fields = fields
+        self.id_field = id_field
+        self.category_field = category_field
+        # Data dictionary each indexed CDE originates from, so that queries skip same-dictionary matches like `analyze` does.
+        self.source_directories = source_directories if source_directories is not None else [None] * len(ids)
+        self.sources = np.asarray(self.source_directories, dtype=object)
+        # Settings that produced `categories` (see `make_categorization`). Queries must categorize the same way.
+        self.categorization = categorization
+        self.inverted_index = inverted_index if inverted_index is not None else self.make_inverted_index(categories)
+
+    @staticmethod
+    def make_categorization(
+        categorizer_name: str,
+        fields: List[str],
+        score_threshold: float,
+        corpus_scoring: bool=False
+    ) -> Dict:
+        """ Identifies the categorization settings that the categories of an index were produced with """
+        return {
+            "categorizer": categorizer_name,
+            "fields": sorted(set(fields)),
+            "score_threshold": score_threshold,
+            "corpus_scoring": corpus_scoring
+        }
+
+    def check_categorizer(self, categorizer: Categorizer) -> None:
+        """ Warn if a categorizer would not produce categories in the same category space as the index """
+        if self.categorization is None:
+            logger.warning("Index does not record how it was categorized, cannot verify that query categories are comparable")
+            return
+        # Corpus-level scores depend on the whole categorized CDE. Queries score each row on its own,
+        # so only a threshold of 0 (keeping every phrase) produces the same categories either way.
+        if self.categorization.get("corpus_scoring", False) and self.categorization["score_threshold"] > 0:
+            raise Exception(
+                "Index was categorized with corpus-level scoring and a non-zero score threshold, " \
+                "which queries cannot reproduce. Rebuild the index from a per-field categorization"
+            )
+        used = self.make_categorization(categorizer.__class__.__name__, categorizer.fields, categorizer.options["score_threshold"])
+        for (setting, expected) in self.categorization.items():
+            if setting == "corpus_scoring":
+                continue
+            if used[setting] != expected:
+                logger.warning(f"Query categorizer {setting} {used[setting]} differs from the index's {expected}, matches may be missed")
+
+    @staticmethod
+    def make_inverted_index(categories: List[List[str]]) -> Dict[str, np.ndarray]:
+        """ Maps each category to the (sorted) positions of the indexed CDEs marked with it """
+        inverted_index = defaultdict(list)
+        for i, row_categories in enumerate(categories):
+            for category in set(row_categories):
+                inverted_index[category].append(i)
+        return {
+            category: np.asarray(positions, dtype=np.int64)
+            for (category, positions) in inverted_index.items()
+        }
+
+    @staticmethod
+    def clean_categories(categories) -> List[str]:
+        # Lists loaded from CSV serialize empty values as [""]
+        if isinstance(categories, str): categories = [categories]
+        return [category for category in categories if category != ""]
+
+    @staticmethod
+    def normalize_embeddings(embeddings: np.ndarray) -> np.ndarray:
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return embeddings / norms
+
+    @classmethod
+    def embed_sentences(cls, analyzer: SemanticAnalyzer, sentences: List[str]) -> np.ndarray:
+        batch_size = cls.EMBEDDING_BATCH_SIZE
+        batches = [
+            analyzer.embed(sentences[i : i + batch_size])
+            for i in range(0, len(sentences), batch_size)
+        ]
+        return cls.normalize_embeddings(np.concatenate(batches)) if len(batches) > 0 else np.zeros((0, 0), dtype=np.float32)
+
+    @classmethod
+    def build(cls, cde: CDE, analyzer: SemanticAnalyzer, categorization: Optional[Dict]=None) -> "HarmonizationIndex":
+        """
+        Build an index from a categorized CDE (i.e. the output of a completed `categorize` run).
+        `categorization` should describe how the CDE was categorized (see `make_categorization`).
+        """
+        start_time = time.time_ns()
+        id_field = analyzer.options["id"]
+        category_field = analyzer.options["field_name"]
+        rows = [row for row in cde if analyzer.field_sentence(row) != ""]
+        logger.info(f"Building index over {len(rows)} CDE fields ({len(cde) - len(rows)} skipped with no analyzable text)")
+        ids = [row[id_field] for row in rows]
+        categories = [cls.clean_categories(row[category_field]) for row in rows]
+        source_directories = [row.get("source_directory") for row in rows]
+        embeddings = cls.embed_sentences(analyzer, [analyzer.field_sentence(row) for row in rows])
+        logger.debug(f"Index built in {(time.time_ns() - start_time) / 1E9:.2f} seconds")
+        return cls(
+            ids,
+            categories,
+            embeddings,
+            analyzer.fields,
+            id_field,
+            category_field,
+            source_directories=source_directories,
+            categorization=categorization
+        )
+
+    def save(self, path: str) -> None:
+        logger.debug(f"Saving index under {path}")
+        if not os.path.exists(path): os.makedirs(path)
+        with open(os.path.join(path, self.METADATA_FILE), "w+") as f:
+            json.dump({
+                "fields": self.fields,
+                "id_field": self.id_field,
+                "category_field": self.category_field,
+                "categorization": self.categorization,
+                "ids": self.ids,
+                "categories": self.categories,
+                "source_directories": self.source_directories,
+                "inverted_index": {
+                    category: positions.tolist() for (category, positions) in self.inverted_index.items()
+                }
+            }, f)
+        np.save(os.path.join(path, self.EMBEDDINGS_FILE), self.embeddings)
+
+    @classmethod
+    def load(cls, path: str) -> "HarmonizationIndex":
+        logger.info(f"Loading index from '{path}'")
+        with open(os.path.join(path, cls.METADATA_FILE), "r") as f:
+            metadata = json.load(f)
+        embeddings = np.load(os.path.join(path, cls.EMBEDDINGS_FILE), mmap_mode="r")
+        return cls(
+            metadata["ids"],
+            metadata["categories"],
+            embeddings,
+            metadata["fields"],
+            metadata["id_field"],
+            metadata["category_field"],
+            source_directories=metadata.get("source_directories"),
+            categorization=metadata.get("categorization"),
+            # Reuse the persisted inverted index rather than rebuilding it from the categories.
+            inverted_index={
+                category: np.asarray(positions, dtype=np.int64)
+                for (category, positions) in metadata["inverted_index"].items()
+            }
+        )
+
+    def find_candidates(
+        self,
+        categories: List[str],
+        grouping_method: str="intersection",
+        source_directory: Optional[str]=None
+    ) -> np.ndarray:
+        """ Positions of indexed CDEs that would have been grouped with a CDE of the given categories (and source) """
+        postings = [self.inverted_index[category] for category in set(categories) if category in self.inverted_index]
+        if len(postings) == 0:
+            return np.zeros(0, dtype=np.int64)
+        candidates = np.unique(np.concatenate(postings))
+        if grouping_method == "equivalence":
+            target = sorted(set(categories))
+            candidates = candidates[[sorted(set(self.categories[j])) == target for j in candidates]]
+        elif grouping_method != "intersection":
+            raise Exception(f"Unrecognized grouping method '{grouping_method}'")
+        if source_directory is not None:
+            # Same as `analyze`, don't pair CDEs originating from the same data dictionary
+            candidates = candidates[self.sources[candidates] != source_directory]
+        return candidates
+
+    def query(
+        self,
+        cde: CDE,
+        categorizer: Categorizer,
+        analyzer: SemanticAnalyzer,
+        min_score: float=0.5,
+        top_k: Optional[int]=None,
+        grouping_method: str="intersection"
+    ) -> CDE:
+        """
+        Categorize and embed only the incoming CDE, then score each row against the indexed CDEs it shares categories with.
+        Returns the categorized rows with their scored matches under `matches`, in the same format as `analyze`.
+        Rows are categorized in-process so that the categorizer's already loaded models are reused across queries.
+        """
+        if top_k is not None and top_k < 1:
+            raise Exception(f"`top_k` must be at least 1, got {top_k}")
+        start_time = time.time_ns()
+        self.check_categorizer(categorizer)
+        category_field = categorizer.options["field_name"]
+        rows = deepcopy(cde)
+        for i, row in enumerate(rows):
+            categories = categorizer.categorize_row(row)
+            if categories is None:
+                logger.error(f"[{i + 1}/{len(rows)}] Failed to categorize field")
+                categories = []
+            row[category_field] = categories
+        sentences = [analyzer.field_sentence(row) for row in rows]
+        embeddings = self.embed_sentences(analyzer, [s for s in sentences if s != ""])
+        embedding_positions = np.cumsum([s != "" for s in sentences]) - 1
+        logger.info(f"Querying index with {len(rows)} CDE fields")
+        for i, row in enumerate(rows):
+            row["matches"] = {}
+            if sentences[i] == "":
+                logger.error(f"[{i + 1}/{len(rows)}] No analyzable text found for field")
+                continue
+            candidates = self.find_candidates(row[category_field], grouping_method, row.get("source_directory"))
+            if len(candidates) == 0:
+                logger.debug(f"[{i + 1}/{len(rows)}] No candidate CDEs share categories with field")
+                continue
+            scores = self.embeddings[candidates] @ embeddings[embedding_positions[i]]
+            keep = scores >= min_score
+            candidates, scores = candidates[keep], scores[keep]
+            order = np.argsort(-scores, kind="stable")
+            if top_k is not None: order = order[:top_k]
+            row["matches"] = {
+                # Same format as `SemanticAnalyzer.regroup_pairings`
+                self.ids[candidates[j]][-6:] : round(float(scores[j]) * 100) / 100
+                for j in order
+            }
+            logger.debug(f"[{i + 1}/{len(rows)}] Matched field against {len(row['matches'])}/{len(candidates)} candidate CDEs")
+        logger.debug(f"Index query completed in {(time.time_ns() - start_time) / 1E9:.2f} seconds")
+        return rows
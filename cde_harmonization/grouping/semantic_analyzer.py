@@ -3,14 +3,17 @@ import logging
 import os
 import itertools
 import time
+import heapq
 import tensorflow as tf
 import tensorflow_hub as tfhub
 import numpy as np
 import networkx as nx
 import multiprocessing
+import multiprocessing.pool
 from scipy.spatial import distance
 from abc import ABC, abstractmethod
-from typing import List, Dict, Tuple, Optional, NamedTuple
+from collections import defaultdict
+from typing import List, Dict, Tuple, Optional, NamedTuple, Iterator
 
 # Make sure TF-Hub caches to the trained_models directory so that weird tempfile stuff doesn't happen.
 CACHE_DIR = os.path.join(os.path.dirname(__file__), "../", "trained_models")
@@ -35,7 +38,14 @@ class SemanticAnalyzer(ABC):
             "grouping_method": "intersection",
             # Minimum score of similarity (scoring mechanism varies by implementation)
             "min_score": 0.5,
+            # Only keep each CDE's `top_k` highest scoring partners (keeps all if None)
+            "top_k": None,
+            # Only keep pairings where each CDE is within the other's `top_k` (mutual kNN). Requires `top_k`.
+            "mutual": False,
             "workers": multiprocessing.cpu_count(),
+            # Number of pairings generated and scored at a time. Pairings are generated lazily, in batches,
+            # so that only the pairings being scored (and those kept) are held in memory.
+            "batch_size": 4096,
             "id": "Digest (variable_name|source_file|source_directory)",
             **options
         }
@@ -47,6 +57,14 @@ class SemanticAnalyzer(ABC):
     def semantic_similarity(self, sentence1: str, sentence2: str) -> float:
         """ Returns a float between 0 and 1 indicating the semantic similarity of the two CDE questions. """
 
+    @abstractmethod
+    def embed(self, sentences: List[str]) -> np.ndarray:
+        """ Returns a (len(sentences), dim) array of sentence embeddings, used for index-backed querying. """
+
+    def field_sentence(self, field: Dict) -> str:
+        """ Joins the analyzed columns of a CDE row into the sentence that gets scored. """
+        return ". ".join([ field[f] for f in self.fields if field.get(f, "") != "" ])
+
     def regroup_pairings(self, pairings: List[Tuple[Dict, Dict, float]]) -> Tuple[List[List[Dict]], nx.Graph]:
         """
         Need to take pairings of similary CDEs and group them with other pairings that share elements in common.
@@ -94,6 +112,43 @@ class SemanticAnalyzer(ABC):
         ]
         return regrouped, G
 
+    def push_pairing(self, heaps: Dict[str, List[Tuple]], field1: Dict, field2: Dict, score: float) -> None:
+        """
+        Offer a pairing to the bounded min-heaps of both of its CDEs, so that kept pairings stay O(n*k) rather than O(pairs).
+        Heap entries are (score, partner_id, field, partner). Partner ids are unique within a heap, so dicts are never compared.
+        """
+        top_k = self.options["top_k"]
+        for (field, partner) in ((field1, field2), (field2, field1)):
+            heap = heaps[field[self.options["id"]]]
+            partner_id = partner[self.options["id"]]
+            # With intersection grouping, the same pairing can be scored once per shared category.
+            if any(entry[1] == partner_id for entry in heap):
+                continue
+            entry = (score, partner_id, field, partner)
+            if len(heap) < top_k:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                heapq.heapreplace(heap, entry)
+
+    def collect_pairings(self, heaps: Dict[str, List[Tuple]]) -> List[Tuple[Dict, Dict, float]]:
+        """ Flatten per-CDE heaps back into unique pairings, optionally only keeping mutual nearest neighbors """
+        mutual = self.options["mutual"]
+        kept_partners = {
+            node_id: set(entry[1] for entry in heap)
+            for (node_id, heap) in heaps.items()
+        }
+        pairings = []
+        for (node_id, heap) in heaps.items():
+            for (score, partner_id, field, partner) in heap:
+                is_mutual = node_id in kept_partners.get(partner_id, ())
+                if mutual and not is_mutual:
+                    continue
+                # Mutual pairings are present in both heaps, only emit them once.
+                if is_mutual and node_id > partner_id:
+                    continue
+                pairings.append((field, partner, score))
+        return pairings
+
     def find_grouping(self, categories: List[str], groupings: List[Grouping]) -> Optional[Grouping]:
         grouping_method = self.options["grouping_method"]
         for grouping in groupings:
@@ -142,51 +197,68 @@ class SemanticAnalyzer(ABC):
         self.logger.debug(f"Average fields per grouping: {sum([len(grouping.fields) for grouping in groupings]) / len(groupings)}")
         return groupings
 
+    def generate_combinations(self, groupings: List[Grouping]) -> Iterator[Tuple[Dict, Dict]]:
+        """ Lazily yield the pairings within each grouping, so that all pairings never have to be materialized at once """
+        for i, grouping in enumerate(groupings):
+            self.logger.debug(f"[{i + 1}/{len(groupings)}] Beginning analysis on grouping")
+            yield from itertools.combinations(grouping.fields, 2)
+
     def analyze_cde(self, cde: CDE) -> List[Dict]:
         start_time = time.time_ns()
         num_workers = self.options["workers"]
         min_score = self.options["min_score"]
+        top_k = self.options["top_k"]
+        mutual = self.options["mutual"]
+        if mutual and top_k is None:
+            raise Exception("Mutual pairing filter requires `top_k` to be set")
+        if top_k is not None and top_k < 1:
+            raise Exception(f"`top_k` must be at least 1, got {top_k}")
+        batch_size = self.options["batch_size"]
         fields_of_interest = []
+        pairing_heaps = defaultdict(list)
         groupings = self.find_groupings(cde)
         self.logger.info(f"Running analysis on {len(groupings)} groupings using {num_workers} workers")
-        grouping_combinations_list = [list(itertools.combinations(g.fields, 2)) for g in groupings]
-        inputs = []
+        # Counted up front (without materializing them) so that progress can be reported against a total.
+        total_combinations = sum(len(g.fields) * (len(g.fields) - 1) // 2 for g in groupings)
+        grouping_combinations = enumerate(self.generate_combinations(groupings))
         skipped_inputs = 0
         pool = multiprocessing.pool.ThreadPool(processes=num_workers)
-        for i, grouping_combinations in enumerate(grouping_combinations_list):
-            self.logger.debug(f"[{i + 1}/{len(grouping_combinations_list)}] Beginning analysis on grouping")
-            for (field1, field2) in grouping_combinations:
-                s1_data = [ field1[field] for field in self.fields if field1[field] != "" ]
-                s2_data = [ field2[field] for field in self.fields if field2[field] != "" ]
-                s1 = ". ".join(s1_data)
-                s2 = ". ".join(s2_data)
+        while True:
+            combinations = list(itertools.islice(grouping_combinations, batch_size))
+            if len(combinations) == 0:
+                break
+            inputs = []
+            for (i, (field1, field2)) in combinations:
+                s1 = self.field_sentence(field1)
+                s2 = self.field_sentence(field2)
                 if (
                     field1["source_directory"] == field2["source_directory"] or
                     # This can occur when categorizations are generated on more columns than analysis is performed on
-                    len(s1_data) == 0 or len(s2_data) == 0
+                    s1 == "" or s2 == ""
                 ):
                     skipped_inputs += 1
                     continue
-                inputs.append((field1, field2, s1, s2))
-        self.logger.debug(f"Skipping {skipped_inputs} pairings originating from same data dictionaries")
-        results = pool.imap(lambda args: self.semantic_similarity(*args), [in_[2:4] for in_ in inputs])
-        i = 0
-        while True:
-            try:
-                similarity = next(results)
-                (field1, field2, _, _) = inputs[i]
-                self.logger.debug(
-                    f"[{i + 1}/{len(inputs)}] " \
-                    f"Scored CDE {field1['variable_name']} {field2['variable_name']} {similarity}{ ' (discarded)' if similarity < min_score else '' }"
-                )
-                if similarity >= min_score:
-                    fields_of_interest.append((field1, field2, similarity))
-            except StopIteration:
-                break
-            except Exception as exc:
-                self.logger.error(f"[{i + 1}/{len(inputs)}] Failed to analyze field")
-            finally:
-                i += 1
+                inputs.append((i, field1, field2, s1, s2))
+            results = pool.imap(lambda args: self.semantic_similarity(*args), [in_[3:5] for in_ in inputs])
+            for (i, field1, field2, _, _) in inputs:
+                try:
+                    similarity = next(results)
+                    self.logger.debug(
+                        f"[{i + 1}/{total_combinations}] " \
+                        f"Scored CDE {field1['variable_name']} {field2['variable_name']} {similarity}{ ' (discarded)' if similarity < min_score else '' }"
+                    )
+                    if similarity >= min_score:
+                        if top_k is None:
+                            fields_of_interest.append((field1, field2, similarity))
+                        else:
+                            self.push_pairing(pairing_heaps, field1, field2, similarity)
+                except Exception as exc:
+                    self.logger.error(f"[{i + 1}/{total_combinations}] Failed to analyze field")
+        pool.close()
+        self.logger.debug(f"Skipped {skipped_inputs}/{total_combinations} pairings originating from same data dictionaries")
+        if top_k is not None:
+            fields_of_interest = self.collect_pairings(pairing_heaps)
+            self.logger.info(f"Kept {len(fields_of_interest)} pairings using top {top_k}{' mutual' if mutual else ''} partners per CDE")
         self.logger.debug(f"CDE categorization completed in {(time.time_ns() - start_time) / 1E9:.2f} seconds")
         return self.regroup_pairings(fields_of_interest)
 
@@ -209,4 +281,7 @@ class USE4Analyzer(SemanticAnalyzer):
             s1,
             s2
         ])
-        return 1 - distance.cosine(*embeddings)
\ No newline at end of file
+        return 1 - distance.cosine(*embeddings)
+
+    def embed(self, sentences: List[str]) -> np.ndarray:
+        return np.asarray(self.model(sentences))
\ No newline at end of file